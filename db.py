@@ -1,93 +1,423 @@
+import asyncio
+import logging
 import os
-import time
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import Session
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import date
+from functools import wraps
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    bindparam,
+    cast,
+    func,
+    insert,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError, DisconnectionError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
-_engine = create_engine(os.environ["DATABASE_URL"], pool_pre_ping=True)
+logger = logging.getLogger(__name__)
 
-DDL = """
+def _async_url(url: str) -> str:
+    # Render дає postgres:// або postgresql:// — явно обираємо async-драйвер psycopg 3
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
+# Без pool_pre_ping: замість SELECT 1 перед кожним checkout — TCP keepalive,
+# recycle старих з'єднань і один повтор, якщо з'єднання все ж відвалилось.
+_engine = create_async_engine(
+    _async_url(os.environ["DATABASE_URL"]),
+    pool_size=5,
+    max_overflow=10,
+    pool_recycle=1800,
+    pool_pre_ping=False,
+    connect_args={
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 5,
+        # Коміт не чекає fsync WAL: при падінні сервера можна втратити останні
+        # ~мілісекунди статистики, але не цілісність. Для логів квізу це ок.
+        "options": "-c synchronous_commit=off",
+    },
+)
+
+DDL = [
+    """
 CREATE TABLE IF NOT EXISTS users (
-  id BIGSERIAL PRIMARY KEY,
+  id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
   chat_id BIGINT UNIQUE,
   lang_mode TEXT,
-  created_at TIMESTAMPTZ DEFAULT now()
-);
+  created_at TIMESTAMPTZ DEFAULT clock_timestamp()
+)
+""",
+    """
 CREATE TABLE IF NOT EXISTS sessions (
-  id BIGSERIAL PRIMARY KEY,
+  id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
   user_id BIGINT REFERENCES users(id),
   mode TEXT,
-  started_at TIMESTAMPTZ DEFAULT now(),
+  started_at TIMESTAMPTZ DEFAULT clock_timestamp(),
   finished_at TIMESTAMPTZ,
   score INT DEFAULT 0,
   wrong INT DEFAULT 0,
   total INT,
   status TEXT
-);
+)
+""",
+    """
 CREATE TABLE IF NOT EXISTS answers (
-  id BIGSERIAL PRIMARY KEY,
+  id BIGSERIAL,  -- IDENTITY на партиційованих таблицях підтримується лише з PG 17
   session_id BIGINT REFERENCES sessions(id),
   question_number INT,
   selected INT,
   correct INT,
   is_correct BOOLEAN,
-  answered_at TIMESTAMPTZ DEFAULT now(),
-  latency_ms INT
-);
-"""
-
-def init_db():
-    # кілька ретраїв, якщо БД прокидається
-    for _ in range(10):
+  answered_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+  latency_ms INT,
+  PRIMARY KEY (id, answered_at)
+) PARTITION BY RANGE (answered_at)
+""",
+    # партиції (answers_default і місячні) створює ensure_answer_partitions() —
+    # на старій БД answers непартиційована, і PARTITION OF тут впав би
+    "CREATE INDEX IF NOT EXISTS ix_sessions_user ON sessions(user_id)",
+    # (session_id, question_number) покриває і запити лише по session_id
+    "CREATE INDEX IF NOT EXISTS ix_answers_session_qnum ON answers(session_id, question_number)",
+]
+
+# Core-опис тих самих таблиць (схему й далі створює DDL) — для заздалегідь
+# зібраних statement'ів нижче: SQLAlchemy кешує їх компіляцію, а psycopg
+# після кількох викликів готує їх на сервері (prepared statements).
+_metadata = MetaData()
+
+users = Table(
+    "users", _metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("chat_id", BigInteger, unique=True),
+    Column("lang_mode", Text),
+    Column("created_at", DateTime(timezone=True), server_default=func.clock_timestamp()),
+)
+
+sessions = Table(
+    "sessions", _metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("user_id", BigInteger),
+    Column("mode", Text),
+    Column("started_at", DateTime(timezone=True), server_default=func.clock_timestamp()),
+    Column("finished_at", DateTime(timezone=True)),
+    Column("score", Integer, server_default="0"),
+    Column("wrong", Integer, server_default="0"),
+    Column("total", Integer),
+    Column("status", Text),
+)
+
+answers = Table(
+    "answers", _metadata,
+    Column("id", BigInteger, primary_key=True),
+    Column("session_id", BigInteger),
+    Column("question_number", Integer),
+    Column("selected", Integer),
+    Column("correct", Integer),
+    Column("is_correct", Boolean),
+    Column("answered_at", DateTime(timezone=True), server_default=func.clock_timestamp()),
+    Column("latency_ms", Integer),
+)
+
+_upsert = pg_insert(users).values(chat_id=bindparam("c"), lang_mode=bindparam("l"))
+_UPSERT_USER = _upsert.on_conflict_do_update(
+    index_elements=[users.c.chat_id], set_={"lang_mode": _upsert.excluded.lang_mode}
+).returning(users.c.id)
+
+_INSERT_SESSION = insert(sessions).values(
+    user_id=bindparam("u"), mode=bindparam("m"), total=bindparam("t"), status="in_progress"
+).returning(sessions.c.id)
+
+_INSERT_ANSWER = insert(answers).values(
+    session_id=bindparam("sid"),
+    question_number=bindparam("q"),
+    selected=bindparam("sel"),
+    correct=bindparam("cor"),
+    is_correct=bindparam("ok", type_=Boolean),
+    latency_ms=bindparam("lat"),
+).inline()  # без implicit RETURNING id — нам він не потрібен
+
+# WITH ins AS (INSERT INTO answers ...) UPDATE sessions ... — один round-trip
+_ok = bindparam("ok", type_=Boolean)
+_LOG_ANSWER = (
+    update(sessions)
+    .where(sessions.c.id == bindparam("sid"))
+    .values(
+        score=sessions.c.score + cast(_ok, Integer),
+        wrong=sessions.c.wrong + (1 - cast(_ok, Integer)),
+    )
+    .add_cte(_INSERT_ANSWER.cte("ins"))
+)
+
+_FINISH_SESSION = (
+    update(sessions)
+    .where(sessions.c.id == bindparam("sid"))
+    .values(
+        score=sessions.c.score + bindparam("s"),
+        wrong=sessions.c.wrong + bindparam("w"),
+        finished_at=func.now(),
+        status=bindparam("st"),
+    )
+)
+
+_BUMP_COUNTERS = (
+    update(sessions)
+    .where(sessions.c.id == bindparam("sid"))
+    .values(score=sessions.c.score + bindparam("s"), wrong=sessions.c.wrong + bindparam("w"))
+)
+
+INIT_ATTEMPTS = 6
+
+# Останній об'єкт у DDL: якщо він є — схема вже повна, DDL можна не ганяти.
+# При додаванні нових об'єктів у DDL оновлюйте і цей маркер.
+_SCHEMA_SENTINEL = "public.ix_answers_session_qnum"
+
+async def init_db():
+    # кілька ретраїв з експоненційною паузою (1, 2, 4, 8, 16 с), якщо БД прокидається;
+    # помилки в самому DDL не ковтаємо
+    for attempt in range(INIT_ATTEMPTS):
         try:
-            with _engine.begin() as conn:
-                conn.exec_driver_sql(DDL)
-            return
-        except Exception:
-            time.sleep(1)
+            async with _engine.begin() as conn:
+                exists = (await conn.execute(
+                    text("SELECT to_regclass(:name)"), {"name": _SCHEMA_SENTINEL}
+                )).scalar()
+                if exists is None:
+                    # по одному statement'у (extended protocol), в одній транзакції
+                    for stmt in DDL:
+                        await conn.exec_driver_sql(stmt)
+            break
+        except OperationalError:
+            if attempt == INIT_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(2 ** attempt, 16))
+    await ensure_answer_partitions()
+
+ANSWER_PARTITIONS_AHEAD = 2  # крім поточного місяця
+
+def _month_start(d: date, months_ahead: int = 0) -> date:
+    m = d.month - 1 + months_ahead
+    return date(d.year + m // 12, m % 12 + 1, 1)
+
+async def ensure_answer_partitions(today: date | None = None):
+    """Створити партиції answers на поточний і наступні місяці (answers_YYYYMM).
+
+    Викликається на старті й щодня з job_queue (main.post_init); старі партиції можна дешево DETACH-нути
+    й архівувати. Тут же створюється answers_default. Якщо answers створена
+    ще без партиціювання — нічого не робимо."""
+    today = today or date.today()
+    async with _engine.begin() as conn:
+        partitioned = (await conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('public.answers')"
+        ))).scalar()
+    if not partitioned:
+        logger.info("answers is not partitioned; skipping monthly partitions")
+        return
+    # сюди падає все, що не влізло в місячні партиції
+    async with _engine.begin() as conn:
+        await conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS answers_default PARTITION OF answers DEFAULT")
+    for i in range(ANSWER_PARTITIONS_AHEAD + 1):
+        lo, hi = _month_start(today, i), _month_start(today, i + 1)
+        try:
+            async with _engine.begin() as conn:
+                await conn.exec_driver_sql(
+                    f"CREATE TABLE IF NOT EXISTS answers_{lo:%Y%m} PARTITION OF answers "
+                    f"FOR VALUES FROM ('{lo.isoformat()}') TO ('{hi.isoformat()}')"
+                )
+        except DBAPIError:
+            # напр. answers_default вже містить рядки за цей місяць
+            logger.warning("Could not create answers partition for %s", f"{lo:%Y-%m}", exc_info=True)
 
 def get_session():
-    return Session(_engine)
+    return AsyncSession(_engine)
+
+@asynccontextmanager
+async def db_session():
+    """Одна сесія = одна транзакція: commit при успіху, rollback при помилці."""
+    async with get_session() as s:
+        try:
+            yield s
+            await s.commit()
+        except Exception:
+            await s.rollback()
+            raise
+
+def _retry_on_disconnect(fn):
+    """Повторити виклик один раз, якщо з'єднання з пулу виявилось мертвим.
+
+    Повторюємо лише те, що точно не застосувалось: збій на checkout або на
+    statement'і всередині ще не закоміченої транзакції (сервер відкотить її
+    при розриві). Обрив під час COMMIT (e.statement is None) не повторюємо —
+    сервер міг уже закомітити, і повтор задвоїв би відповіді й лічильники."""
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        except DisconnectionError:
+            return await fn(*args, **kwargs)
+        except DBAPIError as e:
+            if not e.connection_invalidated or e.statement is None:
+                raise
+            return await fn(*args, **kwargs)
+    return wrapper
+
+# chat_id -> (lang_mode, users.id) для користувачів, уже записаних цим процесом
+USER_CACHE_SIZE = 10_000
+_known_users: "OrderedDict[int, tuple[str, int]]" = OrderedDict()
 
 # ——— хелпери для main.py ———
 
-def ensure_user(chat_id: int, lang_mode: str):
-    with get_session() as s:
-        row = s.execute(text("SELECT id FROM users WHERE chat_id=:c"), {"c": chat_id}).first()
-        if not row:
-            s.execute(text("INSERT INTO users (chat_id, lang_mode) VALUES (:c,:l)"), {"c": chat_id, "l": lang_mode})
-        else:
-            s.execute(text("UPDATE users SET lang_mode=:l WHERE chat_id=:c"), {"l": lang_mode, "c": chat_id})
-        s.commit()
-
-def start_session(chat_id: int, mode: str, total: int) -> int:
-    with get_session() as s:
-        uid = s.execute(text("SELECT id FROM users WHERE chat_id=:c"), {"c": chat_id}).scalar_one()
-        sid = s.execute(
-            text("INSERT INTO sessions (user_id, mode, total, status) VALUES (:u,:m,:t,'in_progress') RETURNING id"),
-            {"u": uid, "m": mode, "t": total},
-        ).scalar_one()
-        s.commit()
-        return sid
-
-def log_answer(session_id: int, qnum: int, selected: int, correct: int, ok: bool, latency_ms: int | None):
-    with get_session() as s:
-        s.execute(
-            text(
-                """
-                INSERT INTO answers (session_id, question_number, selected, correct, is_correct, latency_ms)
-                VALUES (:sid, :q, :sel, :cor, :ok, :lat)
-                """
-            ),
+@_retry_on_disconnect
+async def ensure_user(chat_id: int, lang_mode: str) -> int:
+    """Upsert користувача і повернути його users.id (кешуйте в chat_data["user_id"]).
+
+    Повторний виклик з тією ж мовою для відомого користувача не йде в БД."""
+    known = _known_users.get(chat_id)
+    if known is not None and known[0] == lang_mode:
+        _known_users.move_to_end(chat_id)
+        return known[1]
+    async with db_session() as s:
+        uid = await s.scalar(_UPSERT_USER, {"c": chat_id, "l": lang_mode})
+    _known_users[chat_id] = (lang_mode, uid)
+    _known_users.move_to_end(chat_id)
+    if len(_known_users) > USER_CACHE_SIZE:
+        _known_users.popitem(last=False)
+    return uid
+
+@_retry_on_disconnect
+async def start_session(user_id: int, mode: str, total: int) -> int:
+    async with db_session() as s:
+        return await s.scalar(_INSERT_SESSION, {"u": user_id, "m": mode, "t": total})
+
+@_retry_on_disconnect
+async def log_answer(session_id: int, qnum: int, selected: int, correct: int, ok: bool, latency_ms: int | None):
+    # INSERT відповіді + оновлення лічильників сесії за один round-trip
+    async with db_session() as s:
+        await s.execute(
+            _LOG_ANSWER,
             {"sid": session_id, "q": qnum, "sel": selected, "cor": correct, "ok": ok, "lat": latency_ms},
         )
-        if ok:
-            s.execute(text("UPDATE sessions SET score = score + 1 WHERE id=:sid"), {"sid": session_id})
-        else:
-            s.execute(text("UPDATE sessions SET wrong = wrong + 1 WHERE id=:sid"), {"sid": session_id})
-        s.commit()
-
-def finish_session(session_id: int, status: str):
-    with get_session() as s:
-        s.execute(text("UPDATE sessions SET finished_at=now(), status=:st WHERE id=:sid"),
-                  {"sid": session_id, "st": status})
-        s.commit()
\ No newline at end of file
+
+@_retry_on_disconnect
+async def _finish_session(session_id: int, status: str, pending: list):
+    ok_count = sum(1 for a in pending if a[3])
+    async with db_session() as s:
+        if pending:
+            await s.execute(
+                _INSERT_ANSWER,
+                [
+                    {"sid": session_id, "q": q, "sel": sel, "cor": cor, "ok": ok, "lat": lat}
+                    for q, sel, cor, ok, lat in pending
+                ],
+            )
+        await s.execute(
+            _FINISH_SESSION,
+            {"sid": session_id, "st": status, "s": ok_count, "w": len(pending) - ok_count},
+        )
+
+async def finish_session(session_id: int, status: str, pending=()):
+    """Закрити сесію; `pending` — буфер chat_data["pending_answers"] із кортежів
+    (qnum, selected, correct, ok, latency_ms), записується одним executemany."""
+    # список будуємо до ретраю: генератор, вичерпаний першою спробою, дав би 0/0
+    await _finish_session(session_id, status, list(pending))
+
+# ——— фонова черга відповідей: запис у БД поза шляхом користувача ———
+
+ANSWER_BATCH = 64            # максимум відповідей за один flush
+ANSWER_FLUSH_INTERVAL = 0.2  # секунд чекаємо, поки набереться пачка
+
+_answer_queue: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+_flusher_task: asyncio.Task | None = None
+
+dropped_answers = 0  # скільки відповідей відкинуто через переповнену чергу
+
+async def queue_answer(session_id: int, qnum: int, selected: int, correct: int, ok: bool, latency_ms: int | None):
+    """Неблокуюча альтернатива log_answer: відповідь запише фоновий flusher.
+
+    Якщо БД застрягла і черга повна — відповідь відкидаємо (статистика), а не
+    тримаємо обробник користувача."""
+    global dropped_answers
+    try:
+        _answer_queue.put_nowait((session_id, qnum, selected, correct, ok, latency_ms))
+    except asyncio.QueueFull:
+        dropped_answers += 1
+        logger.warning("Answer queue full; dropped answer for session %s (%d dropped so far)",
+                       session_id, dropped_answers)
+
+@_retry_on_disconnect
+async def _write_answers(batch):
+    # лічильники сесій агрегуємо, щоб на кожну сесію був один UPDATE
+    counters = {}
+    for sid, _q, _sel, _cor, ok, _lat in batch:
+        s_w = counters.setdefault(sid, [0, 0])
+        s_w[0 if ok else 1] += 1
+    async with db_session() as s:
+        await s.execute(
+            _INSERT_ANSWER,
+            [
+                {"sid": sid, "q": q, "sel": sel, "cor": cor, "ok": ok, "lat": lat}
+                for sid, q, sel, cor, ok, lat in batch
+            ],
+        )
+        await s.execute(
+            _BUMP_COUNTERS,
+            [{"sid": sid, "s": sc, "w": wr} for sid, (sc, wr) in counters.items()],
+        )
+
+async def _flush(batch):
+    try:
+        await _write_answers(batch)
+    except Exception:
+        logger.exception("Failed to write %d buffered answers", len(batch))
+
+async def _run_answer_flusher():
+    # None у черзі — сигнал зупинки від stop_answer_flusher()
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _answer_queue.get()
+        if item is None:
+            return
+        batch = [item]
+        deadline = loop.time() + ANSWER_FLUSH_INTERVAL
+        stop = False
+        while len(batch) < ANSWER_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(_answer_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        await _flush(batch)
+        if stop:
+            return
+
+def start_answer_flusher():
+    global _flusher_task
+    if _flusher_task is None:
+        _flusher_task = asyncio.get_running_loop().create_task(_run_answer_flusher())
+
+async def stop_answer_flusher():
+    """Зупинити flusher, дочекавшись запису всього, що вже лежить у черзі."""
+    global _flusher_task
+    if _flusher_task is not None:
+        await _answer_queue.put(None)
+        await _flusher_task
+        _flusher_task = None
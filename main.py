@@ -1,15 +1,23 @@
+import asyncio
 import logging
 import os
 import json
+import pickle
+import random
+import re
 import time
+from array import array
 
 from telegram import BotCommand
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 from functools import wraps
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InputFile, ReplyKeyboardMarkup, KeyboardButton
+import telegram
+import telegram.error
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InputFile, ReplyKeyboardMarkup, KeyboardButton, MessageEntity
 import difflib
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CallbackContext,
@@ -21,14 +29,247 @@ from telegram.ext import (
     filters,
 )
 
-with open("questions.json", "r", encoding="utf-8") as f:
-    QUESTIONS = json.load(f)
+try:
+    import orjson
+except ImportError:  # orjson опційний — падаємо назад на stdlib json
+    orjson = None
+
+try:
+    from rapidfuzz import fuzz, process as fuzz_process
+except ImportError:  # rapidfuzz опційний — падаємо назад на difflib
+    fuzz = fuzz_process = None
+
+try:
+    import uvloop
+except ImportError:  # uvloop опційний (і недоступний на Windows) — звичайний asyncio-цикл
+    uvloop = None
+
+QUESTIONS_PATH = "questions.json"
+QUESTIONS_CACHE = "questions.pkl"  # розпарсений questions.json, перебудовується за mtime
+
+def _load_questions() -> list:
+    try:
+        if os.path.getmtime(QUESTIONS_CACHE) >= os.path.getmtime(QUESTIONS_PATH):
+            with open(QUESTIONS_CACHE, "rb") as f:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    with open(QUESTIONS_PATH, "rb") as f:
+        questions = orjson.loads(f.read()) if orjson else json.load(f)
+    try:
+        tmp = QUESTIONS_CACHE + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(questions, f, protocol=5)
+        os.replace(tmp, QUESTIONS_CACHE)
+    except OSError:
+        # read-only FS — просто працюємо без кешу
+        pass
+    return questions
+
+QUESTIONS = _load_questions()
+
+# Рядок варіанта після відповіді: ключ (обраний?, правильний?)
+OPTION_LETTERS = ("A", "B", "C", "D")
+OPTION_MAP = {l: i for i, l in enumerate(OPTION_LETTERS)}
+ANSWER_PREFIX = {
+    (True, False): "❌ <b>{l}. {t}</b>",
+    (True, True): "✅ <b>{l}. {t}</b>",
+    (False, True): "✅ {l}. {t}",
+    (False, False): "       {l}. {t}",
+}
+
+def _precompute_question_text(q: dict) -> None:
+    """Заздалегідь зібрати незмінні HTML-блоки питання для кожного lang_mode."""
+    # Дані лише для читання — фіксуємо варіанти як кортежі
+    options_en = q["options"] = tuple(q["options"])
+    options_uk = q["options_uk"] = tuple(q.get("options_uk", ()))
+    labels = OPTION_LETTERS
+    q["_q_text"] = {
+        "en": f"<b>{q['question']}</b>",
+        "bilingual": f"<b>🇬🇧 {q['question']}</b>\n<b>🇺🇦 {q['question_uk']}</b>",
+    }
+    # Тексти варіантів без розмітки (для екрана після відповіді)
+    q["_options_en"] = options_en
+    q["_options_bi"] = (
+        tuple(f"{o} / {u}" for o, u in zip(options_en, options_uk)) if options_uk else options_en
+    )
+    q["_opts_text"] = {
+        "en": "\n".join(f"<b>{l}.</b> {o}" for l, o in zip(labels, q["_options_en"])),
+        "bilingual": "\n".join(f"<b>{l}.</b> {o}" for l, o in zip(labels, q["_options_bi"])),
+    }
+    # Блок варіантів після відповіді для кожного обраного індексу (правильний фіксований)
+    correct = q["answer_index"]
+    q["_answered_text"] = {
+        lang: tuple(
+            "\n".join(
+                ANSWER_PREFIX[(i == sel, i == correct)].format(l=labels[i], t=t)
+                for i, t in enumerate(opts)
+            )
+            for sel in range(len(labels))
+        )
+        for lang, opts in (("en", q["_options_en"]), ("bilingual", q["_options_bi"]))
+    }
+
+for _q in QUESTIONS:
+    _precompute_question_text(_q)
+
+N_QUESTIONS = len(QUESTIONS)
+ALL_INDICES = tuple(range(N_QUESTIONS))  # пул для random.sample в режимі іспиту
+EXAM_SIZE = 30
+HAS_ENOUGH_FOR_EXAM = N_QUESTIONS >= EXAM_SIZE
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")  # у порядку пріоритету
+
+def _scan_images(folder: str = "images") -> Dict[int, str]:
+    """question_number -> шлях до картинки; один прохід по теці при старті."""
+    found: Dict[int, str] = {}
+    try:
+        with os.scandir(folder) as it:
+            entries = list(it)
+    except FileNotFoundError:
+        return found
+    for entry in entries:
+        stem, ext = os.path.splitext(entry.name)
+        if ext not in IMAGE_EXTENSIONS or not stem.isdigit() or not entry.is_file():
+            continue
+        if entry.stat().st_size == 0:  # порожній файл Telegram не прийме
+            continue
+        qnum = int(stem)
+        prev = found.get(qnum)
+        if prev is None or IMAGE_EXTENSIONS.index(ext) < IMAGE_EXTENSIONS.index(os.path.splitext(prev)[1]):
+            found[qnum] = f"{folder}/{entry.name}"
+    return found
+
+IMAGE_PATHS = _scan_images()
+
+# --- Паралельні кортежі (SoA) для гарячих шляхів; індекс = позиція в QUESTIONS ---
+LANG_KEYS = ("en", "bilingual")
+Q_NUMBER = tuple(q["question_number"] for q in QUESTIONS)
+Q_ANSWER_IDX = array("b", (q["answer_index"] for q in QUESTIONS))
+Q_TEXT = {lang: tuple(q["_q_text"][lang] for q in QUESTIONS) for lang in LANG_KEYS}
+Q_OPTS_TEXT = {lang: tuple(q["_opts_text"][lang] for q in QUESTIONS) for lang in LANG_KEYS}
+Q_ANSWERED = {lang: tuple(q["_answered_text"][lang] for q in QUESTIONS) for lang in LANG_KEYS}
+Q_EXPL = tuple(q.get("explanation") for q in QUESTIONS)
+Q_OPTIONS_EN = tuple(q["options"] for q in QUESTIONS)
+Q_OPTIONS_UK = tuple(q["options_uk"] for q in QUESTIONS)
+Q_IMG_PATH = tuple(IMAGE_PATHS.get(n) for n in Q_NUMBER)
+# Далі все читається з кортежів вище — сирі dict'и питань більше не потрібні
+del QUESTIONS, _q
+
+# --- Текстові відповіді: рядок у нижньому регістрі -> індекс варіанта ---
+def _answer_lookup(qidx: int) -> Dict[str, int]:
+    lookup = {str(i + 1): i for i in range(len(OPTION_LETTERS))}
+    lookup.update({l.lower(): i for i, l in enumerate(OPTION_LETTERS)})
+    # EN іде останнім, тож при однаковому тексті перемагає англійський варіант
+    for opts in (Q_OPTIONS_UK[qidx], Q_OPTIONS_EN[qidx]):
+        lookup.update({o.lower(): i for i, o in enumerate(opts)})
+    return lookup
+
+ANSWER_LOOKUP = tuple(_answer_lookup(i) for i in ALL_INDICES)
+# ratio = 2·M/(len(a)+len(b)) ≥ 0.7 неможливий, якщо текст довший за ~1.86× найдовшого ключа —
+# такі повідомлення відкидаємо без нечіткого пошуку
+ANSWER_MAX_LEN = tuple(int(max(map(len, lookup)) * (2 / 0.7 - 1)) + 1 for lookup in ANSWER_LOOKUP)
+
+def match_text_answer(qidx: int, text: str) -> int:
+    """Індекс варіанта за текстом користувача (точний збіг, далі нечіткий) або -1."""
+    lookup = ANSWER_LOOKUP[qidx]
+    hit = lookup.get(text)
+    if hit is not None:
+        return hit
+    if len(text) > ANSWER_MAX_LEN[qidx]:
+        return -1
+    if fuzz_process:
+        best = fuzz_process.extractOne(text, lookup.keys(), scorer=fuzz.ratio, score_cutoff=70)
+        return lookup[best[0]] if best else -1
+    matches = difflib.get_close_matches(text, lookup.keys(), n=1, cutoff=0.7)
+    return lookup[matches[0]] if matches else -1
+
+# Без кешу: бюджет пам'яті під картинки — лише IMAGE_BYTES; великі файли читаються
+# з диска на вимогу (і то до першого file_id)
+def _image_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+IMAGE_PRELOAD_MAX_FILE = 512 * 1024
+IMAGE_PRELOAD_MAX_TOTAL = 64 * 1024 * 1024
+
+def _preload_images() -> Dict[str, bytes]:
+    """Зчитати дрібні картинки в пам'ять при старті (до IMAGE_PRELOAD_MAX_TOTAL сумарно);
+    решта читається з диска на вимогу."""
+    loaded: Dict[str, bytes] = {}
+    total = 0
+    for path in IMAGE_PATHS.values():
+        try:
+            size = os.path.getsize(path)
+            if size > IMAGE_PRELOAD_MAX_FILE or total + size > IMAGE_PRELOAD_MAX_TOTAL:
+                continue
+            loaded[path] = _image_bytes(path)
+        except OSError:
+            continue
+        total += size
+    return loaded
+
+IMAGE_BYTES = _preload_images()
+
+async def _image_file(path: str) -> InputFile:
+    """Картинка з пам'яті замість повторного читання з диска на кожне питання.
+    Якщо її не передзавантажено — читаємо в окремому потоці, щоб не блокувати event loop."""
+    data = IMAGE_BYTES.get(path)
+    if data is None:
+        data = await asyncio.to_thread(_image_bytes, path)
+    return InputFile(data, filename=os.path.basename(path))
+
+# question_number -> Telegram file_id уже завантаженої картинки
+FILE_IDS_PATH = ".file_ids.json"
+
+def _load_file_ids() -> Dict[int, str]:
+    try:
+        with open(FILE_IDS_PATH, "rb") as f:
+            raw = orjson.loads(f.read()) if orjson else json.load(f)
+        return {int(k): v for k, v in raw.items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+def _save_file_ids() -> None:
+    try:
+        data = {str(k): v for k, v in FILE_IDS.items()}
+        with open(FILE_IDS_PATH, "wb") as f:
+            f.write(orjson.dumps(data) if orjson else json.dumps(data).encode())
+    except OSError:
+        logger.warning("Could not persist Telegram file_ids", exc_info=True)
+
+FILE_IDS: Dict[int, str] = _load_file_ids()
+
+def _is_file_id_error(e: telegram.error.BadRequest) -> bool:
+    msg = e.message.lower()
+    return "wrong file identifier" in msg or "file_id" in msg or "wrong remote file" in msg
+
+async def _send_question_photo(bot, chat_id: int, qnum: int, path: str, **kwargs):
+    """send_photo, що після першого завантаження шле лише file_id, а не байти."""
+    file_id = FILE_IDS.get(qnum)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except telegram.error.BadRequest as e:
+            # Лише помилка саме file_id (від іншого бота/протух) — завантажуємо заново;
+            # решту (довгий підпис, чат не знайдено…) повторне завантаження не виправить
+            if not _is_file_id_error(e):
+                raise
+            FILE_IDS.pop(qnum, None)
+    msg = await bot.send_photo(chat_id=chat_id, photo=await _image_file(path), **kwargs)
+    if msg.photo:
+        FILE_IDS[qnum] = msg.photo[-1].file_id
+    return msg
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Пауза (сек) між показом результату і наступним питанням
+NEXT_DELAY = float(os.getenv("NEXT_DELAY", "0.3"))
+# Скільки апдейтів обробляти одночасно; HTTP-пул до Bot API того ж розміру
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
 
 logger = logging.getLogger(__name__)
 
@@ -90,6 +331,55 @@ def antispam(handler):
             pass
     return wrapper  
 
+def safe_answer(handler):
+    """Answer the callback query before the handler runs.
+    A stale query ("Query is too old") is only logged; the handler still runs."""
+    @wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        try:
+            await update.callback_query.answer()
+        except telegram.error.BadRequest as e:
+            if "Query is too old" not in e.message:
+                raise
+            logger.warning("Callback query too old; skipping answer.")
+        return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+# Локи відповіді по chat_id — поза chat_data, бо там порожність означає «тест перервано»
+_ANSWER_LOCKS: Dict[int, asyncio.Lock] = {}
+
+def per_chat_lock(handler):
+    """Serialise the handler per chat; a concurrent update for a busy chat is dropped
+    so a double tap can't count the same question twice."""
+    @wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        chat_id = update.effective_chat.id
+        lock = _ANSWER_LOCKS.get(chat_id) or _ANSWER_LOCKS.setdefault(chat_id, asyncio.Lock())
+        if lock.locked():
+            if update.callback_query:
+                try:
+                    await update.callback_query.answer("⏳ Processing…")
+                except Exception:
+                    pass
+            return
+        try:
+            async with lock:
+                return await handler(update, context, *args, **kwargs)
+        finally:
+            # Ніхто не чекає на лок (зайняті чати відкидаємо), тож вільний лок одразу
+            # прибираємо — інакше словник ріс би на кожен чат за весь час роботи
+            if not lock.locked() and _ANSWER_LOCKS.get(chat_id) is lock:
+                del _ANSWER_LOCKS[chat_id]
+    return wrapper
+
+async def edit_if_changed(query, text: str, **kwargs):
+    """Edit the callback message only if text or markup would actually change.
+    Saves a round-trip that would end in "Message is not modified"."""
+    msg = query.message
+    if msg and msg.text_html == text and msg.reply_markup == kwargs.get("reply_markup"):
+        return msg
+    return await query.edit_message_text(text, **kwargs)
+
 @antispam
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
@@ -124,6 +414,12 @@ async def _purge_old_ui(context: CallbackContext, chat_id: int):
     if summary_id:
         await _safe_delete(context.bot, chat_id, summary_id)
 
+def _keep_clicked_summary(chat_data, query) -> None:
+    """Забути summary_message_id, якщо натиснуто кнопку саме на підсумку —
+    інакше purge видалить повідомлення, яке обробник ще збирається редагувати."""
+    if query.message and chat_data.get("summary_message_id") == query.message.message_id:
+        chat_data.pop("summary_message_id", None)
+
 # --- Helper: soft purge UI (delete only last open question if has kb, and summary) ---
 async def _purge_ui_soft(context: CallbackContext, chat_id: int):
     # Delete only the last question message if it still has an inline keyboard.
@@ -208,13 +504,60 @@ def progress_bar(position: int, total: int, wrong_steps: set, bar_len: int = 30)
             bar.append("·")
     return "".join(bar)
 
+def render_question(qidx: int, position: int, total: int, lang_key: str, wrong_steps: set,
+                    selected: Optional[int] = None, explain: bool = False) -> str:
+    """HTML питання для send_question і для екрана після відповіді.
+    Блоки тексту/варіантів заздалегідь зібрані; тут лише заголовок і прогрес-бар,
+    які залежать від чату."""
+    try:
+        bar = progress_bar(position, total, wrong_steps) + "\n"
+    except Exception:
+        bar = ""
+    if selected is None:
+        opts = Q_OPTS_TEXT[lang_key][qidx]
+    else:
+        opts = Q_ANSWERED[lang_key][qidx][selected]
+    expl = Q_EXPL[qidx] if explain else None
+    tail = f"\n{bar}<b>Explanation:</b>\n<i>{expl}</i>" if expl is not None else ""
+    return (
+        f"<i><b>Question {position} of {total}</b></i>\n\n"
+        f"{Q_TEXT[lang_key][qidx]}\n{bar}{opts}{tail}"
+    )
+
+# Партиції answers на наступні місяці дозаводимо щодня, а не лише при старті:
+# інакше довгоживучий процес почне складати рядки в answers_default
+PARTITION_CHECK_INTERVAL = 24 * 60 * 60
+
+async def _ensure_partitions_job(context: CallbackContext) -> None:
+    import db
+    await db.ensure_answer_partitions()
+
 async def post_init(application):
+    # Postgres опційний: схему створюємо лише якщо задано DATABASE_URL
+    if os.getenv("DATABASE_URL"):
+        import db
+        await db.init_db()
+        db.start_answer_flusher()
+        application.job_queue.run_repeating(
+            _ensure_partitions_job,
+            interval=PARTITION_CHECK_INTERVAL,
+            first=PARTITION_CHECK_INTERVAL,
+            name="ensure_answer_partitions",
+        )
     commands = [
         BotCommand("start", "Start the quiz"),
         BotCommand("stop", "Stop the quiz")
     ]
     await application.bot.set_my_commands(commands)
 
+async def post_shutdown(application):
+    # Зберегти file_id картинок, щоб після рестарту не завантажувати їх знову
+    _save_file_ids()
+    # Дописати відповіді, що ще лежать у фоновій черзі БД
+    if os.getenv("DATABASE_URL"):
+        import db
+        await db.stop_answer_flusher()
+
 
 MODE_OPTIONS = [
     [
@@ -230,15 +573,46 @@ LANG_OPTIONS = [
     ]
 ]
 
+# Готові розмітки меню (незмінні, будуються один раз)
+MODE_KB = InlineKeyboardMarkup(MODE_OPTIONS)
+LANG_KB = InlineKeyboardMarkup(LANG_OPTIONS)
+LANG_KB_PAUSED = InlineKeyboardMarkup(
+    LANG_OPTIONS + [[InlineKeyboardButton("▶️ Continue", callback_data="RESUME_PAUSE")]]
+)
+
+# --- Mode descriptions (one table instead of if/elif copies in handlers) ---
+_LEARNING_EN = (
+    "🧠 <b>Learning Mode</b> – shows the correct answer and explanation immediately after each question. Includes all 120 questions.\n"
+    f"💡 <i>Tip:</i> send a number (1–{N_QUESTIONS}) to jump to that question."
+)
+_LEARNING_UK = (
+    "🧠 <b>Навчальний режим</b> – показує правильну відповідь і пояснення одразу після кожного питання. Усього 120 питань.\n"
+    f"💡 <i>Порада:</i> надішліть число (1–{N_QUESTIONS}), щоб перейти до відповідного питання."
+)
+_EXAM_EN = "📝 <b>Exam Mode</b> – 30 random questions, no hints. You must answer at least 25 correctly to pass."
+_EXAM_UK = "📝 <b>Режим іспиту</b> – 30 випадкових питань, без підказок. Для успішного складання потрібно дати щонайменше 25 правильних відповідей."
+
+# Shown after language choice: both modes + prompt
+MODE_PROMPT = {
+    "en": f"{_LEARNING_EN}\n\n{_EXAM_EN}\n\nPlease choose a mode:",
+    "bilingual": (
+        f"{_LEARNING_EN}\n{_LEARNING_UK}\n\n{_EXAM_EN}\n{_EXAM_UK}\n\n"
+        "Please choose mode / Будь ласка, оберіть режим:"
+    ),
+}
+# Shown after mode choice: only the selected mode
+MODE_DESC_EN = {"learning": _LEARNING_EN, "exam": _EXAM_EN}
+MODE_DESC_BI = {"learning": f"{_LEARNING_EN}\n{_LEARNING_UK}", "exam": f"{_EXAM_EN}\n{_EXAM_UK}"}
+MODE_DESC = {"en": MODE_DESC_EN, "bilingual": MODE_DESC_BI}
+
 # --- Reply keyboard: persistent bottom menu ---
-def build_reply_menu() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("🔄 Restart BOT")]],
-        resize_keyboard=True,
-        one_time_keyboard=False,
-        selective=False,
-        is_persistent=True,
-    )
+REPLY_MENU = ReplyKeyboardMarkup(
+    [[KeyboardButton("🔄 Restart BOT")]],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    selective=False,
+    is_persistent=True,
+)
 
 @antispam
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -255,8 +629,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     context.chat_data["paused"] = False
     context.chat_data["wrong_steps"] = set()
     # Drop any stale exam state
-    context.chat_data.pop("used_questions", None)
     context.chat_data.pop("exam_questions", None)
+    context.chat_data.pop("max_questions", None)
 
         # --- force clean any dangling UI before we show language picker ---
     chat_id = update.effective_chat.id
@@ -293,9 +667,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
     # If paused, add Continue button
-    lang_options = LANG_OPTIONS.copy()
-    if context.chat_data.get("paused"):
-        lang_options.append([InlineKeyboardButton("▶️ Continue", callback_data="RESUME_PAUSE")])
+    lang_kb = LANG_KB_PAUSED if context.chat_data.get("paused") else LANG_KB
 
     # Remove any previous question/summary with buttons so user can't press old ones
     await _purge_ui_soft(context, update.effective_chat.id)
@@ -311,14 +683,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         chat_id=update.effective_chat.id,
         message_id=warm_msg.message_id,
         text="Please choose your language / Будь ласка, оберіть мову:",
-        reply_markup=InlineKeyboardMarkup(lang_options)
+        reply_markup=lang_kb
     )
     # Attach persistent bottom menu with a single restart button
     try:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             # text="Menu",  # short label; keeps the reply keyboard visible
-            reply_markup=build_reply_menu(),
+            reply_markup=REPLY_MENU,
         )
     except Exception:
         pass
@@ -326,40 +698,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     context.chat_data["lang_prompt_id"] = getattr(edited, "message_id", warm_msg.message_id)
     _release_lock(context.chat_data)
 @antispam
+@safe_answer
 async def handle_main_menu(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    import telegram.error
+    # Remove the pressed message's buttons and delete it
     try:
-        await query.answer()
-        # Remove the pressed message's buttons and delete it
-        try:
-            await query.edit_message_reply_markup(reply_markup=None)
-        except Exception:
-            pass
-        await _purge_ui_soft(context, query.message.chat.id)
-        await _safe_delete(context.bot, query.message.chat.id, query.message.message_id)
-    except telegram.error.BadRequest as e:
-        if "Query is too old" in str(e):
-            logger.warning("Callback query too old; skipping answer.")
-            return
-        else:
-            raise
+        await query.edit_message_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+    _keep_clicked_summary(context.chat_data, query)
+    await _purge_ui_soft(context, query.message.chat.id)
+    await _safe_delete(context.bot, query.message.chat.id, query.message.message_id)
     # Housekeeping: clear stored lang_prompt_id since we delete the message anyway
     context.chat_data.pop("lang_prompt_id", None)
     context.chat_data.clear()
     await start(update, context)
 
 @antispam
+@safe_answer
 async def handle_language(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    import telegram.error
-    try:
-        await query.answer()
-    except telegram.error.BadRequest as e:
-        if "Query is too old" in str(e):
-            logger.warning("Callback query too old; skipping answer.")
-        else:
-            raise
     await _purge_ui_soft(context, query.message.chat.id)
     # Clear stored language prompt id so old prompts don't linger
     context.chat_data.pop("lang_prompt_id", None)
@@ -367,116 +725,86 @@ async def handle_language(update: Update, context: CallbackContext) -> None:
     context.chat_data["lang_mode"] = lang_mode
     context.chat_data["current_index"] = 0
     context.chat_data["score"] = 0
-    # New logic for text assignment based on lang_mode
-    if lang_mode == "bilingual":
-        total = len(QUESTIONS)
-        text = (
-            "🧠 <b>Learning Mode</b> – shows the correct answer and explanation immediately after each question. Includes all 120 questions.\n"
-            f"💡 <i>Tip:</i> send a number (1–{total}) to jump to that question.\n"
-            "🧠 <b>Навчальний режим</b> – показує правильну відповідь і пояснення одразу після кожного питання. Усього 120 питань.\n"
-            f"💡 <i>Порада:</i> надішліть число (1–{total}), щоб перейти до відповідного питання.\n\n"
-            "📝 <b>Exam Mode</b> – 30 random questions, no hints. You must answer at least 25 correctly to pass.\n"
-            "📝 <b>Режим іспиту</b> – 30 випадкових питань, без підказок. Для успішного складання потрібно дати щонайменше 25 правильних відповідей.\n\n"
-            "Please choose mode / Будь ласка, оберіть режим:"
-        )
-    elif lang_mode == "en":
-        total = len(QUESTIONS)
-        text = (
-            "🧠 <b>Learning Mode</b> – shows the correct answer and explanation immediately after each question. Includes all 120 questions.\n"
-            f"💡 <i>Tip:</i> send a number (1–{total}) to jump to that question.\n\n"
-            "📝 <b>Exam Mode</b> – 30 random questions, no hints. You must answer at least 25 correctly to pass.\n\n"
-            "Please choose a mode:"
-        )
-    elif lang_mode == "learning":
-        text = (
-            "🧠 <b>Learning Mode</b> – shows the correct answer and explanation immediately after each question. Includes all 120 questions."
-        )
-    elif lang_mode == "exam":
-        text = (
-            "📝 <b>Exam Mode</b> – 30 random questions, no hints. You must answer at least 25 correctly to pass."
-        )
-    else:
-        text = "Please choose a mode:"
+    text = MODE_PROMPT.get(lang_mode, "Please choose a mode:")
 
-    await query.edit_message_text(
+    await edit_if_changed(
+        query,
         text,
-        reply_markup=InlineKeyboardMarkup(MODE_OPTIONS),
-        parse_mode=ParseMode.HTML
+        reply_markup=MODE_KB
     )
 
 @antispam
+@safe_answer
 async def handle_mode(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    import telegram.error
-    try:
-        await query.answer()
-        await query.edit_message_reply_markup(reply_markup=None)
-    except telegram.error.BadRequest as e:
-        if "Query is too old" in str(e):
-            logger.warning("Callback query too old; skipping answer.")
-        else:
-            raise
+    await query.edit_message_reply_markup(reply_markup=None)
     mode = "learning" if query.data == "mode_learning" else "exam"
     context.chat_data["mode"] = mode
+    context.chat_data["max_questions"] = N_QUESTIONS
     context.chat_data["current_index"] = 0
     context.chat_data["score"] = 0
     context.chat_data["paused"] = False
     context.chat_data["wrong_count"] = 0
     context.chat_data["wrong_steps"] = set()
+    # Кнопки підсумку ведуть сюди: натиснутий підсумок нижче редагуємо, тож не видаляємо його
+    _keep_clicked_summary(context.chat_data, query)
     # Make sure no previous question/summary message with buttons remains
     await _purge_ui_soft(context, query.message.chat.id)
-    # Reset used_questions only on new exam start
+    # New exam sample only on exam start
     if mode == "exam":
         # Fresh exam state — do not inherit from Learning mode
         context.chat_data["wrong_count"] = 0
         context.chat_data["score"] = 0
         context.chat_data["current_index"] = 0
-        context.chat_data["used_questions"] = []
         context.chat_data["wrong_steps"] = set()
-        import random
-        if len(QUESTIONS) < 30:
+        if not HAS_ENOUGH_FOR_EXAM:
             await query.edit_message_text("❌ Not enough questions to start the exam. Please add more questions.")
             return
-        sample = random.sample(range(len(QUESTIONS)), 30)
+        sample = random.sample(ALL_INDICES, EXAM_SIZE)
         context.chat_data["exam_questions"] = sample
+        context.chat_data["max_questions"] = EXAM_SIZE
 
     # Show only selected mode's description after setting mode
     lang = context.chat_data.get("lang_mode", "en")
-    selected_mode = mode
-    if lang == "en":
-        total = len(QUESTIONS)
-        await query.edit_message_text(
-            "📝 <b>Exam Mode</b> – 30 random questions, no hints. You must answer at least 25 correctly to pass."
-            if selected_mode == "exam"
-            else "🧠 <b>Learning Mode</b> – shows the correct answer and explanation immediately after each question. Includes all 120 questions.\n"
-                 f"💡 <i>Tip:</i> send a number (1–{total}) to jump to that question.",
-            parse_mode=ParseMode.HTML
-        )
-    elif lang == "bilingual":
-        total = len(QUESTIONS)
-        await query.edit_message_text(
-            "📝 <b>Exam Mode</b> – 30 random questions, no hints. You must answer at least 25 correctly to pass.\n"
-            "📝 <b>Режим іспиту</b> – 30 випадкових питань, без підказок. Для успішного складання потрібно дати щонайменше 25 правильних відповідей."
-            if selected_mode == "exam"
-            else "🧠 <b>Learning Mode</b> – shows the correct answer and explanation immediately after each question. Includes all 120 questions.\n"
-                 f"💡 <i>Tip:</i> send a number (1–{total}) to jump to that question.\n"
-                 "🧠 <b>Навчальний режим</b> – показує правильну відповідь і пояснення одразу після кожного питання. Усього 120 питань.\n"
-                 f"💡 <i>Порада:</i> надішліть число (1–{total}), щоб перейти до відповідного питання.",
-            parse_mode=ParseMode.HTML
-        )
+    desc = MODE_DESC.get(lang, {}).get(mode)
+    if desc:
+        await edit_if_changed(query, desc)
 
     await send_question(query.message.chat.id, context)
 
-def build_option_keyboard() -> InlineKeyboardMarkup:
-    # Buttons show plain letters; labels in question text are bolded
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("A", callback_data="A"),
-            InlineKeyboardButton("B", callback_data="B"),
-            InlineKeyboardButton("C", callback_data="C"),
-            InlineKeyboardButton("D", callback_data="D")
-        ]
-    ])
+# --- Static inline keyboards (PTB markup objects are immutable, so build once) ---
+# Buttons show plain letters; labels in question text are bolded
+OPTION_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("A", callback_data="A"),
+        InlineKeyboardButton("B", callback_data="B"),
+        InlineKeyboardButton("C", callback_data="C"),
+        InlineKeyboardButton("D", callback_data="D")
+    ]
+])
+
+EXAM_SCORE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔁 Start Exam Again", callback_data="mode_exam")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="MAIN_MENU")],
+])
+
+LEARNING_SCORE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔁 Restart Learning", callback_data="mode_learning"),
+     InlineKeyboardButton("📝 Start Exam", callback_data="mode_exam")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="MAIN_MENU")],
+])
+
+FAIL_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔁 Try Again / Спробувати ще раз", callback_data="mode_exam")],
+    [InlineKeyboardButton("🏠 Main Menu", callback_data="MAIN_MENU")]
+])
+
+EXAM_MISSING_KB = InlineKeyboardMarkup([[
+    InlineKeyboardButton("🔁 Start Again", callback_data="start_exam"),
+    InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu"),
+]])
+
+RESTART_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Start Again", callback_data="mode_exam")]])
 
 
 async def send_question(chat_id: int, context: CallbackContext) -> None:
@@ -490,116 +818,53 @@ async def send_question(chat_id: int, context: CallbackContext) -> None:
     chat_data["_sending_question"] = True
 
     try:
-        # Видаляємо лише останнє відкрите питання з клавіатурою (якщо є)
-        await _purge_open_question(context, chat_id)
+        # Видаляємо лише останнє відкрите питання з клавіатурою (якщо є) —
+        # паралельно з відправкою нового, щоб не чекати зайвий round-trip
+        purge = asyncio.create_task(_purge_open_question(context, chat_id))
 
         mode = chat_data.get("mode", "learning")
+        # current_index — вказівник на наступне питання: в іспиті це позиція
+        # у фіксованій вибірці exam_questions, у навчанні — індекс питання
         if mode == "exam":
             exam_questions = chat_data.get("exam_questions", [])
-            used_questions = chat_data.get("used_questions", [])
-            used_ids = set(used_questions)
-
-            # залишки ще не використаних
-            remaining = [qidx for qidx in exam_questions if qidx not in used_ids]
-            if not remaining:
-                await send_score(chat_id, context)
-                return
-
-            # шукаємо перше не використане починаючи з current_index
-            next_qidx = None
-            start = chat_data.get("current_index", 0)
-            for i in range(start, len(exam_questions)):
-                if exam_questions[i] not in used_ids:
-                    next_qidx = exam_questions[i]
-                    chat_data["current_index"] = i
-                    break
-
-            # якщо після start нічого не знайшлось — беремо з початку
-            if next_qidx is None:
-                for i, qidx in enumerate(exam_questions):
-                    if qidx not in used_ids:
-                        next_qidx = qidx
-                        chat_data["current_index"] = i
-                        break
-
-            if next_qidx is None:
+            if index >= len(exam_questions):
+                await purge
                 await send_score(chat_id, context)
                 return
-
-            chat_data.setdefault("used_questions", []).append(next_qidx)
-            q = QUESTIONS[next_qidx]
+            qidx = exam_questions[index]
+            total_questions = len(exam_questions)
         else:
-            if index >= len(QUESTIONS):
+            if index >= N_QUESTIONS:
+                await purge
                 await send_score(chat_id, context)
                 return
-            q = QUESTIONS[index]
-
-        # Заголовок (без лічильників)
-        if mode == "exam":
-            total_questions = len(chat_data.get("exam_questions", []))
-            position = len(chat_data.get("used_questions", []))
-            header = f"<i><b>Question {position} of {total_questions}</b></i>"
-        else:
-            total_questions = len(QUESTIONS)
-            position = index + 1
-            header = f"<i><b>Question {position} of {total_questions}</b></i>"
+            qidx = index
+            total_questions = N_QUESTIONS
 
-        lines = [header, ""]
-
-        # Текст питання
-        if lang_mode == "bilingual":
-            lines.append(f"<b>🇬🇧 {q['question']}</b>")
-            lines.append(f"<b>🇺🇦 {q['question_uk']}</b>")
-        else:
-            # якщо 'en' — прапор не показуємо
-            if lang_mode == "en":
-                lines.append(f"<b>{q['question']}</b>")
-            else:
-                lines.append(f"<b>🇬🇧 {q['question']}</b>")
-
-        try:
-            lines.append(progress_bar(position, total_questions, chat_data.get("wrong_steps", set())))
-        except Exception:
-            pass
-
-        # Варіанти
-        option_labels = ["A", "B", "C", "D"]
-        options_en = q["options"]
-        options_uk = q.get("options_uk", [])
-        for idx, label in enumerate(option_labels):
-            if lang_mode == "bilingual" and options_uk:
-                lines.append(f"<b>{label}.</b> {options_en[idx]} / {options_uk[idx]}")
-            else:
-                lines.append(f"<b>{label}.</b> {options_en[idx]}")
+        lang_key = "bilingual" if lang_mode == "bilingual" else "en"
+        text = render_question(qidx, index + 1, total_questions, lang_key, chat_data.get("wrong_steps", set()))
 
         # Картинка (якщо є)
-        image_filename = None
-        for ext in [".jpg", ".jpeg", ".png", ".webp"]:
-            path = f"images/{q['question_number']}{ext}"
-            if os.path.exists(path):
-                image_filename = path
-                break
-
-        text = "\n".join(lines)
-        keyboard = build_option_keyboard()
+        image_filename = Q_IMG_PATH[qidx]
+        keyboard = OPTION_KB
 
         # Відправка
         if image_filename:
-            with open(image_filename, "rb") as photo:
-                msg = await context.bot.send_photo(
-                    chat_id=chat_id,
-                    photo=photo,
-                    caption=text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=keyboard
-                )
+            send = _send_question_photo(
+                context.bot,
+                chat_id,
+                Q_NUMBER[qidx],
+                image_filename,
+                caption=text,
+                reply_markup=keyboard
+            )
         else:
-            msg = await context.bot.send_message(
+            send = context.bot.send_message(
                 chat_id=chat_id,
                 text=text,
-                parse_mode=ParseMode.HTML,
                 reply_markup=keyboard
             )
+        _, msg = await asyncio.gather(purge, send)
 
         # Позначаємо, що є активна клавіатура в останньому повідомленні
         chat_data["last_message_id"] = msg.message_id
@@ -614,6 +879,59 @@ async def send_question(chat_id: int, context: CallbackContext) -> None:
         # Гарантовано знімаємо прапорець відправки
         chat_data["_sending_question"] = False
 
+# --- Шаблони підсумку: пари (фрагмент, жирний?) ---
+# Текст фіксованої форми шлемо з готовими MessageEntity замість HTML-розмітки,
+# тож Telegram не парсить його на кожне повідомлення
+def _bold_entities(parts) -> Tuple[str, List[MessageEntity]]:
+    """Зібрати текст і bold-entities; offset/length рахуються в UTF-16, як вимагає Bot API."""
+    chunks: List[str] = []
+    entities: List[MessageEntity] = []
+    offset = 0
+    for chunk, bold in parts:
+        length = len(chunk.encode("utf-16-le")) // 2
+        if bold:
+            entities.append(MessageEntity(MessageEntity.BOLD, offset, length))
+        chunks.append(chunk)
+        offset += length
+    return "".join(chunks), entities
+
+def _exam_result_parts(result_en: str, result_uk: str) -> tuple:
+    return (
+        ("🎉 You scored {score} out of {total}!", True),
+        (f"\n{result_en}\n\n", False),
+        ("🇺🇦 Ви набрали {score} із {total} балів!", True),
+        (f"\n{result_uk}", False),
+    )
+
+EXAM_PASSED_PARTS = _exam_result_parts("✅ You passed the exam!", "✅ Ви склали іспит!")
+EXAM_FAILED_PARTS = _exam_result_parts("❌ You did not pass the exam.", "❌ Ви не склали іспит.")
+LEARNING_RESULT_EN = (
+    ("📚 Learning finished!", True),
+    ("\n✅ Correct: ", False), ("{correct}", True),
+    ("\n❌ Fails: ", False), ("{wrong}", True),
+)
+LEARNING_RESULT_BI = LEARNING_RESULT_EN + (
+    ("\n— — — — — — — — — —\n", False),
+    ("📚 Навчання завершено!", True),
+    ("\n✅ Правильних: ", False), ("{correct}", True),
+    ("\n❌ Помилок: ", False), ("{wrong}", True),
+)
+EXAM_FAIL_FAST_PARTS = (
+    ("❌ You made {wrong} mistakes. Test failed.", True),
+    ("\n\n", False),
+    ("🇺🇦 Ви зробили {wrong} помилок. Тест не складено.", True),
+)
+
+def _render_parts(parts, **values) -> Tuple[str, List[MessageEntity]]:
+    return _bold_entities((chunk.format(**values), bold) for chunk, bold in parts)
+
+# Ключі chat_data, що належать одному проходу тесту (скидаються після підсумку)
+QUIZ_STATE_KEYS = (
+    "mode", "current_index", "score", "wrong_count", "wrong_steps",
+    "exam_questions", "awaiting_next", "resume_question", "paused",
+    "last_message_id", "last_has_kb", "_consumed_msg_id", "max_questions",
+)
+
 async def send_score(chat_id: int, context: CallbackContext) -> None:
     chat_data = context.chat_data
     mode = chat_data.get("mode", "learning")
@@ -623,57 +941,30 @@ async def send_score(chat_id: int, context: CallbackContext) -> None:
     if mode == "exam":
         total = len(chat_data.get("exam_questions", []))
         passed = score >= 25
-        result_en = "✅ You passed the exam!" if passed else "❌ You did not pass the exam."
-        result_uk = "✅ Ви склали іспит!" if passed else "❌ Ви не склали іспит."
-
-        text = (
-            f"<b>🎉 You scored {score} out of {total}!</b>\n"
-            f"{result_en}\n\n"
-            f"<b>🇺🇦 Ви набрали {score} із {total} балів!</b>\n"
-            f"{result_uk}"
-        )
-        buttons = [
-            [InlineKeyboardButton("🔁 Start Exam Again", callback_data="mode_exam")],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data="MAIN_MENU")],
-        ]
+        text, entities = _render_parts(EXAM_PASSED_PARTS if passed else EXAM_FAILED_PARTS, score=score, total=total)
+        keyboard = EXAM_SCORE_KB
     else:
         # Learning mode summary
-        total = len(QUESTIONS)
         wrong = chat_data.get("wrong_count", 0)
-        correct = score
-
-        if lang == "bilingual":
-            text = (
-                f"<b>📚 Learning finished!</b>\n"
-                f"✅ Correct: <b>{correct}</b>\n❌ Fails: <b>{wrong}</b>\n"
-                f"— — — — — — — — — —\n"
-                f"<b>📚 Навчання завершено!</b>\n"
-                f"✅ Правильних: <b>{correct}</b>\n❌ Помилок: <b>{wrong}</b>"
-            )
-        else:
-            text = (
-                f"<b>📚 Learning finished!</b>\n"
-                f"✅ Correct: <b>{correct}</b>\n❌ Fails: <b>{wrong}</b>"
-            )
+        parts = LEARNING_RESULT_BI if lang == "bilingual" else LEARNING_RESULT_EN
+        text, entities = _render_parts(parts, correct=score, wrong=wrong)
 
         # Offer to restart learning or start exam, and main menu
-        buttons = [
-            [InlineKeyboardButton("🔁 Restart Learning", callback_data="mode_learning"),
-             InlineKeyboardButton("📝 Start Exam", callback_data="mode_exam")],
-            [InlineKeyboardButton("🏠 Main Menu", callback_data="MAIN_MENU")],
-        ]
+        keyboard = LEARNING_SCORE_KB
 
     msg = await context.bot.send_message(
         chat_id=chat_id,
         text=text,
-        parse_mode=ParseMode.HTML,
-        reply_markup=InlineKeyboardMarkup(buttons),
+        entities=entities,
+        parse_mode=None,
+        reply_markup=keyboard,
     )
+    # Reset quiz state after summary is shown so next action starts fresh;
+    # lang_mode stays, so the next quiz skips language selection
+    for key in QUIZ_STATE_KEYS:
+        chat_data.pop(key, None)
     # Remember summary id so we can delete/disable it on next actions
-    context.chat_data["summary_message_id"] = msg.message_id
-
-    # Clear state after summary is shown so next action starts fresh
-    chat_data.clear()
+    chat_data["summary_message_id"] = msg.message_id
 
 async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Reset state and behave exactly like /start
@@ -681,387 +972,266 @@ async def quiz_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await _purge_ui_soft(context, update.effective_chat.id)
     await start(update, context)
 
+async def _advance(chat_id: int, context: CallbackContext) -> None:
+    chat_data = context.chat_data
+    current_index = chat_data["current_index"] = chat_data.get("current_index", 0) + 1
+    chat_data.pop("awaiting_next", None)
+    # Довжина проходу кешується в chat_data при виборі режиму
+    if current_index < chat_data.get("max_questions", N_QUESTIONS):
+        await send_question(chat_id, context)
+    else:
+        await send_score(chat_id, context)
+
+async def _advance_after_answer(context: CallbackContext) -> None:
+    """Job після NEXT_DELAY: показати наступне питання або підсумок."""
+    # За час паузи користувач міг перезапустити тест — тоді відповідь уже не актуальна
+    if context.chat_data is None or context.chat_data.get("_consumed_msg_id") != context.job.data:
+        return
+    await _advance(context.job.chat_id, context)
+
 @antispam
+@per_chat_lock
 async def answer_handler(update: Update, context: CallbackContext) -> None:
-    # Support both button (callback_query) and text answers (update.message)
-    import telegram.error
+    # Button answer (A–D); typed answers go to text_answer_handler
     chat_data = context.chat_data
-    # If this is a callback query (button answer)
-    if update.callback_query:
-        query = update.callback_query
-        # --- Early drop of stale callbacks ---
-        # Ignore callbacks that aren't from the last message with active keyboard
-        if _is_stale_callback(context.chat_data, query.message.message_id):
-            try:
-                await query.answer()
-            except Exception:
-                pass
-            return
+    query = update.callback_query
+    # --- Early drop of stale callbacks ---
+    # Ignore callbacks that aren't from the last message with active keyboard
+    if _is_stale_callback(context.chat_data, query.message.message_id):
         try:
-            # Do not answer yet – we'll show a toast (✅/❌) after we compute correctness.
-            # Remove the inline keyboard right away to prevent double taps.
-            try:
-                await query.edit_message_reply_markup(reply_markup=None)
-            except Exception:
-                pass
-        except telegram.error.BadRequest as e:
-            if "Query is too old" in str(e):
-                logger.warning("Callback query too old; skipping answer.")
-            else:
-                raise
-        # --- Per-message consume guard: process each question only once even if user taps many times ---
-        consumed_id = context.chat_data.get("_consumed_msg_id")
-        if consumed_id == query.message.message_id:
-            # already handled this message; politely ack and stop
-            try:
-                await query.answer("Please try again or restart the BOT")
-            except Exception:
-                pass
+            await query.answer()
+        except Exception:
+            pass
+        return
+    # Do not answer yet – we'll show a toast (✅/❌) after we compute correctness.
+    # Remove the inline keyboard right away to prevent double taps.
+    try:
+        await query.edit_message_reply_markup(reply_markup=None)
+        # Кнопок більше немає: навіть якщо показати результат не вдасться,
+        # purge у send_question не повинен видаляти це повідомлення
+        chat_data["last_has_kb"] = False
+    except Exception:
+        pass
+    # --- Per-message consume guard: process each question only once even if user taps many times ---
+    consumed_id = context.chat_data.get("_consumed_msg_id")
+    if consumed_id == query.message.message_id:
+        # already handled this message; politely ack and stop
+        try:
+            await query.answer("Please try again or restart the BOT")
+        except Exception:
+            pass
+        return
+    context.chat_data["_consumed_msg_id"] = query.message.message_id
+    if not chat_data:
+        if query.message:
+            await edit_if_changed(
+                query,
+                "⏸ Quiz was interrupted. Resuming from last question...",
+                reply_markup=None
+            )
+            context.chat_data["current_index"] = 0
+            context.chat_data["score"] = 0
+            context.chat_data["mode"] = "exam"
+            context.chat_data["paused"] = False
+            lang_mode = context.chat_data.get("lang_mode", "en")
+            if lang_mode not in ("en", "bilingual"):
+                context.chat_data["lang_mode"] = "en"
+            if "exam_questions" not in context.chat_data:
+                if not HAS_ENOUGH_FOR_EXAM:
+                    await query.edit_message_text("❌ Not enough questions to resume exam. Please add more questions.")
+                    return
+                sample = random.sample(ALL_INDICES, EXAM_SIZE)
+                context.chat_data["exam_questions"] = sample
+            context.chat_data["max_questions"] = len(context.chat_data["exam_questions"])
+            await send_question(query.message.chat.id, context)
+        return
+
+    mode = chat_data.get("mode", "learning")
+    is_exam = mode == "exam"
+    if is_exam and "exam_questions" not in chat_data:
+        if query.message:
+            await query.edit_message_text(
+                "❌ Exam data missing.",
+                reply_markup=EXAM_MISSING_KB
+            )
+        return
+    # Do not remove previous inline keyboard here to avoid UI flicker.
+    current_index = chat_data.get("current_index", 0)
+    if is_exam:
+        question_index = chat_data["exam_questions"][current_index]
+    else:
+        question_index = current_index
+    lang_key = "bilingual" if chat_data.get("lang_mode", "en") == "bilingual" else "en"
+    # Роутер шле сюди лише A–D, тож ключ завжди є
+    selected_index = OPTION_MAP[query.data]
+    total_questions = chat_data.get("max_questions", N_QUESTIONS)
+    if current_index < total_questions:
+        chat_id = query.message.chat.id
+        message_id = query.message.message_id
+        correct_index = Q_ANSWER_IDX[question_index]
+        is_correct = selected_index == correct_index
+        wrong_count = chat_data.get("wrong_count", 0)
+        # Track score/mistakes first so the toast shows the updated count
+        if is_correct:
+            score = chat_data["score"] = chat_data.get("score", 0) + 1
+            toast = f"✅ Correct. ({score} Correct)"
+        else:
+            if mode in ("exam", "learning"):
+                wrong_count = chat_data["wrong_count"] = wrong_count + 1
+            toast = f"❌ Incorrect. ({wrong_count} Fails)"
+        # Ephemeral toast with quick feedback plus counters (uses updated values)
+        try:
+            await query.answer(toast)
+        except Exception:
+            pass
+        # --- Insert fail fast logic for exam mode ---
+        if is_exam and wrong_count >= 6:
+            text, entities = _render_parts(EXAM_FAIL_FAST_PARTS, wrong=wrong_count)
+            await query.message.reply_text(text, entities=entities, parse_mode=None, reply_markup=FAIL_KB)
+            # як і в send_score: скидаємо лише стан проходу, lang_mode лишається
+            for key in QUIZ_STATE_KEYS:
+                chat_data.pop(key, None)
             return
-        context.chat_data["_consumed_msg_id"] = query.message.message_id
-        if not chat_data:
-            if query.message:
-                await query.edit_message_text(
-                    "⏸ Quiz was interrupted. Resuming from last question...",
+        # --- End fail fast logic ---
+        pos_for_bar = current_index + 1
+        # Do not show explanation in exam mode
+        # Show explanation only in learning mode, and only if correct
+        formatted_question = render_question(
+            question_index, pos_for_bar, total_questions, lang_key,
+            chat_data.get("wrong_steps", set()),
+            selected=selected_index,
+            explain=mode == "learning" and is_correct,
+        )
+        # Show result and explanation in place, then automatically move to next question.
+        # Картинка не змінюється, тож для фото міняємо лише підпис — без повторного завантаження
+        try:
+            if query.message.photo:
+                await query.edit_message_caption(
+                    caption=formatted_question,
                     reply_markup=None
                 )
-                context.chat_data["current_index"] = 0
-                context.chat_data["score"] = 0
-                context.chat_data["mode"] = "exam"
-                context.chat_data["paused"] = False
-                lang_mode = context.chat_data.get("lang_mode", "en")
-                if lang_mode not in ("en", "bilingual"):
-                    context.chat_data["lang_mode"] = "en"
-                if "exam_questions" not in context.chat_data:
-                    import random
-                    if len(QUESTIONS) < 30:
-                        await query.edit_message_text("❌ Not enough questions to resume exam. Please add more questions.")
-                        return
-                    sample = random.sample(range(len(QUESTIONS)), 30)
-                    context.chat_data["exam_questions"] = sample
-                await send_question(query.message.chat.id, context)
-            return
-
-        mode = chat_data.get("mode", "learning")
-        if mode == "exam" and "exam_questions" not in chat_data:
-            if query.message:
+            elif query.message.text:
                 await query.edit_message_text(
-                    "❌ Exam data missing.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Start Again", callback_data="start_exam"),
-         InlineKeyboardButton("🏠 Main Menu", callback_data="main_menu")]])
-                )
-            return
-        # Do not remove previous inline keyboard here to avoid UI flicker.
-        current_index = chat_data.get("current_index", 0)
-        if mode == "exam":
-            used_questions = chat_data.get("used_questions", [])
-            if used_questions:
-                question_index = used_questions[-1]
-            else:
-                question_index = chat_data["exam_questions"][current_index]
-        else:
-            question_index = current_index
-        lang_mode = chat_data.get("lang_mode", "en")
-        option_map: Dict[str, int] = {"A": 0, "B": 1, "C": 2, "D": 3}
-        selected_letter = query.data
-        selected_index = option_map.get(selected_letter, -1)
-        max_questions = 30 if mode == "exam" else len(QUESTIONS)
-        if current_index < max_questions and 0 <= selected_index < 4:
-            question = QUESTIONS[question_index]
-            correct_index = question["answer_index"]
-            is_correct = selected_index == correct_index
-            if is_correct:
-                chat_data["score"] = chat_data.get("score", 0) + 1
-            else:
-                # Track mistakes first so the toast shows the updated count
-                if mode in ("exam", "learning"):
-                    chat_data["wrong_count"] = chat_data.get("wrong_count", 0) + 1
-            # Ephemeral toast with quick feedback plus counters (uses updated values)
-            try:
-                if is_correct:
-                    total_correct = chat_data.get("score", 0)
-                    toast = f"✅ Correct. ({total_correct} Correct)"
-                else:
-                    fails_now = chat_data.get("wrong_count", 0)
-                    toast = f"❌ Incorrect. ({fails_now} Fails)"
-                await query.answer(toast)
-            except Exception:
-                pass
-            option_labels = ["A", "B", "C", "D"]
-            options_en = question["options"]
-            options_uk = question.get("options_uk", [])
-            options_text = []
-            for idx, opt_en in enumerate(options_en):
-                opt_uk = options_uk[idx] if lang_mode == "bilingual" and options_uk else ""
-                line = f"{opt_en}" if not opt_uk else f"{opt_en} / {opt_uk}"
-                option_letter = option_labels[idx]
-                if idx == selected_index and idx != correct_index:
-                    options_text.append(f"❌ <b>{option_letter}. {line}</b>")
-                elif idx == selected_index and idx == correct_index:
-                    options_text.append(f"✅ <b>{option_letter}. {line}</b>")
-                elif idx == correct_index:
-                    options_text.append(f"✅ {option_letter}. {line}")
-                else:
-                    options_text.append(f"       {option_letter}. {line}")
-            total_questions = 30 if mode == 'exam' else len(QUESTIONS)
-            wrong_count = chat_data.get("wrong_count", 0)
-            # --- Insert fail fast logic for exam mode ---
-            if mode == "exam" and wrong_count >= 6:
-                text = (
-                    f"<b>❌ You made {wrong_count} mistakes. Test failed.</b>\n\n"
-                    f"<b>🇺🇦 Ви зробили {wrong_count} помилок. Тест не складено.</b>\n\n"
+                    text=formatted_question,
+                    reply_markup=None
                 )
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔁 Try Again / Спробувати ще раз", callback_data="mode_exam")],
-                    [InlineKeyboardButton("🏠 Main Menu", callback_data="MAIN_MENU")]
-                ])
-                await query.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
-                chat_data.clear()
-                return
-            # --- End fail fast logic ---
-            if mode == "exam":
-                position = len(chat_data.get("used_questions", []))
-                result_title = f"<i><b>Question {position} of {total_questions}</b></i>"
-            else:
-                result_title = f"<i><b>Question {current_index + 1} of {total_questions}</b></i>"
-            full_text = [result_title, ""]
-            if lang_mode == "bilingual":
-                full_text += [
-                    f"<b>🇬🇧 {question['question']}</b>",
-                    f"<b>🇺🇦 {question['question_uk']}</b>"
-                ]
-            else:
-                if lang_mode == "en":
-                    full_text.append(f"<b>{question['question']}</b>")
-                else:
-                    full_text.append(f"<b>🇬🇧 {question['question']}</b>")
-            try:
-                if mode == "exam":
-                    pos_for_bar = len(chat_data.get("used_questions", []))
-                else:
-                    pos_for_bar = current_index + 1
-                # Update wrong_steps set if not already done
-                wrong_steps = chat_data.get("wrong_steps", set())
-                full_text.append(progress_bar(pos_for_bar, total_questions, wrong_steps))
-            except Exception:
-                pass
-            full_text += options_text
-            # Do not show explanation in exam mode
-            # Show explanation only in learning mode, and only if correct
-            if mode == "exam" or not is_correct:
-                pass
-            else:
-                if mode == "learning" and "explanation" in question:
-                    try:
-                        if mode == "exam":
-                            pos_for_bar = len(chat_data.get("used_questions", []))
-                        else:
-                            pos_for_bar = current_index + 1
-                        wrong_steps = chat_data.get("wrong_steps", set())
-                        full_text.append(progress_bar(pos_for_bar, total_questions, wrong_steps))
-                    except Exception:
-                        pass
-                    full_text.append("<b>Explanation:</b>")
-                    full_text.append(f"*{question['explanation']}*")
-            formatted_question = "\n".join(full_text)
-            # Load image based on question_number
-            index = chat_data.get("current_index", 0)
-            image_filename = None
-            possible_extensions = [".jpg", ".jpeg", ".png", ".webp"]
-            for ext in possible_extensions:
-                path = f"images/{question['question_number']}{ext}"
-                if os.path.exists(path):
-                    image_filename = path
-                    break
-            # Show result and explanation, then automatically move to next question
-            if image_filename:
-                try:
-                    import telegram
-                    with open(image_filename, "rb") as photo:
-                        await context.bot.edit_message_media(
-                            chat_id=query.message.chat.id,
-                            message_id=query.message.message_id,
-                            media=telegram.InputMediaPhoto(photo, caption=formatted_question, parse_mode=ParseMode.HTML),
-                            reply_markup=None
-                        )
-                    context.chat_data["last_message_id"] = query.message.message_id
-                    context.chat_data["last_has_kb"] = False
-                except Exception as e:
-                    logger.warning(f"Failed to edit photo, fallback to delete/send: {e}")
-                    if query.message:
-                        await context.bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.message_id)
-                    with open(image_filename, "rb") as photo:
-                        msg = await context.bot.send_photo(
-                            chat_id=query.message.chat.id,
-                            photo=photo,
-                            caption=formatted_question,
-                            parse_mode=ParseMode.HTML,
-                            reply_markup=None
-                        )
-                    context.chat_data["last_message_id"] = msg.message_id
-                    context.chat_data["last_has_kb"] = False
-            else:
-                if query.message and query.message.text:
-                    msg = await query.edit_message_text(
-                        text=formatted_question,
-                        reply_markup=None,
-                        parse_mode=ParseMode.HTML
-                    )
-                    context.chat_data["last_message_id"] = msg.message_id
-                    context.chat_data["last_has_kb"] = False
-            # Track wrong_steps persistently
-            # Compute current position (1-based)
-            if mode == "exam":
-                pos_for_bar = len(chat_data.get("used_questions", []))
-            else:
-                pos_for_bar = current_index + 1
-            if not is_correct:
-                ws = chat_data.setdefault("wrong_steps", set())
-                ws.add(pos_for_bar)
-            import asyncio
-            await asyncio.sleep(1.0)
-            chat_data["current_index"] = chat_data.get("current_index", 0) + 1
-            chat_data.pop("awaiting_next", None)
-            max_questions = len(chat_data.get("exam_questions", [])) if chat_data.get("mode", "learning") == "exam" else len(QUESTIONS)
-            if chat_data["current_index"] < max_questions:
-                await send_question(query.message.chat.id, context)
-            else:
-                await send_score(query.message.chat.id, context)
-            return
+            chat_data["last_message_id"] = message_id
+            chat_data["last_has_kb"] = False
+        except telegram.error.TelegramError as e:
+            logger.warning("Failed to show answered question: %s", e)
+        # Track wrong_steps persistently (pos_for_bar is the 1-based position)
+        if not is_correct:
+            ws = chat_data.setdefault("wrong_steps", set())
+            ws.add(pos_for_bar)
+        # В іспиті пояснень немає — читати нічого, переходимо одразу
+        # Наступне питання з'являється раніше за LOCK_TTL (одразу або через NEXT_DELAY) —
+        # antispam-лок інакше відхилив би швидкий тап по ньому; дубль по старому відсікає _consumed_msg_id
+        _release_lock(chat_data)
+        if is_exam or NEXT_DELAY <= 0:
+            await _advance(chat_id, context)
+        # Перехід до наступного питання — окремою задачею, хендлер завершується одразу
+        elif context.job_queue:
+            context.job_queue.run_once(
+                _advance_after_answer,
+                when=NEXT_DELAY,
+                chat_id=chat_id,
+                data=message_id,
+            )
         else:
-            if query.message and query.message.text:
-                await query.edit_message_text("Invalid selection. Please try again.\n\nНеправильний вибір. Спробуйте ще раз.")
+            await asyncio.sleep(NEXT_DELAY)
+            await _advance(chat_id, context)
         return
+    else:
+        if query.message and query.message.text:
+            await query.edit_message_text("Invalid selection. Please try again.\n\nНеправильний вибір. Спробуйте ще раз.")
+    return
 
-    # --- Text answer logic ---
-    # If this is a text message (user sends answer as text)
-    if update.message and update.message.text:
-        user_msg = update.message.text.strip()
-        # Defensive: skip if no quiz running
-        if not chat_data or "mode" not in chat_data:
-            return
-        mode = chat_data.get("mode", "learning")
+@antispam
+@per_chat_lock
+async def text_answer_handler(update: Update, context: CallbackContext) -> None:
+    """Answer typed as text: full option text (EN/UK), letter, number or a jump in Learning."""
+    chat_data = context.chat_data
+    # Defensive: skip if no quiz running — один get до будь-якої обробки тексту
+    mode = chat_data.get("mode")
+    if mode is None:
+        return
+    user_msg = update.message.text.strip()
+    chat_id = update.effective_chat.id
 
-        # Numeric jump is ONLY for Learning Mode
-        if user_msg.isdigit():
-            if mode != "learning":
-                await update.message.reply_text("ℹ️ Jump by question number is available only in Learning Mode.")
-                return
-            # Jump to a specific question number in Learning
-            n = int(user_msg)
-            total = len(QUESTIONS)
-            if 1 <= n <= total:
-                # When jumping, remove the previous question message if it still has an inline keyboard
-                last_id = chat_data.get("last_message_id")
-                last_has_kb = chat_data.get("last_has_kb")
-                if last_id and last_has_kb:
-                    try:
-                        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=last_id)
-                    except Exception as _:
-                        # If deletion fails (already gone/edited), ignore
-                        pass
-                    chat_data["last_message_id"] = None
-                    chat_data["last_has_kb"] = False
-                chat_data["current_index"] = n - 1
-                await send_question(update.effective_chat.id, context)
-            else:
-                await update.message.reply_text(f"⚠️ Please enter a number from 1 to {total}.")
-            return
-        current_index = chat_data.get("current_index", 0)
-        if mode == "exam":
-            used_questions = chat_data.get("used_questions", [])
-            if used_questions:
-                question_index = used_questions[-1]
-            else:
-                question_index = chat_data["exam_questions"][current_index]
-        else:
-            question_index = current_index
-        question = QUESTIONS[question_index]
-        options_en = question["options"]
-        options_uk = question.get("options_uk", [])
-        option_labels = ["A", "B", "C", "D"]
-        # Accept answers as full text or letter (A/B/C/D)
-        all_possible_answers = []
-        # Add English and Ukrainian options (case-insensitive)
-        for idx, opt in enumerate(options_en):
-            all_possible_answers.append((opt, idx))
-        for idx, opt in enumerate(options_uk):
-            all_possible_answers.append((opt, idx))
-        # Also support A/B/C/D as answer
-        for idx, label in enumerate(option_labels):
-            all_possible_answers.append((label, idx))
-        # Lowercase mapping for fuzzy match
-        user_text = user_msg.lower()
-        answer_candidates = [ans.lower() for ans, _ in all_possible_answers]
-        # Use difflib to get close matches (allowing for typos)
-        matches = difflib.get_close_matches(user_text, answer_candidates, n=1, cutoff=0.7)
-        selected_index = -1
-        if matches:
-            match = matches[0]
-            for i, (ans, idx) in enumerate(all_possible_answers):
-                if ans.lower() == match:
-                    selected_index = idx
-                    break
-        else:
-            # fallback: try if user typed number 1-4
-            if user_text in ["1", "2", "3", "4"]:
-                selected_index = int(user_text) - 1
-        # If not recognized, reply and do NOT advance
-        if selected_index < 0 or selected_index >= 4:
-            await update.message.reply_text("❌ Could not recognize your answer. Please reply with the full text or letter (A, B, C, D).")
+    # Numeric jump is ONLY for Learning Mode
+    # Лише ASCII-цифри: int() сам прийняв би "+5", "-1", "1_0" і не-ASCII цифри
+    number = int(user_msg) if user_msg.isascii() and user_msg.isdecimal() else None
+    if number is not None:
+        if mode != "learning":
+            await update.message.reply_text("ℹ️ Jump by question number is available only in Learning Mode.")
             return
-        correct_index = question["answer_index"]
-        is_correct = selected_index == correct_index
-        if is_correct:
-            chat_data["score"] = chat_data.get("score", 0) + 1
-        elif mode == "learning":
-            chat_data["wrong_count"] = chat_data.get("wrong_count", 0) + 1
-        # Prepare feedback message
-        feedback_lines = []
-        if is_correct:
-            feedback_lines.append("✅ Correct!")
-        else:
-            feedback_lines.append("❌ Incorrect.")
-        # In learning mode, show explanation if correct
-        if mode == "learning" and "explanation" in question:
-            feedback_lines.append(progress_bar(current_index + 1, len(QUESTIONS), chat_data.get("wrong_steps", set())))
-            feedback_lines.append("<b>Explanation:</b>")
-            feedback_lines.append(f"*{question['explanation']}*")
-        # Reply to user
-        await update.message.reply_text(
-            "\n".join(feedback_lines),
-            parse_mode=ParseMode.HTML
-        )
-        # Advance to next question
-        chat_data["current_index"] = chat_data.get("current_index", 0) + 1
-        max_questions = len(chat_data.get("exam_questions", [])) if chat_data.get("mode", "learning") == "exam" else len(QUESTIONS)
-        if chat_data["current_index"] < max_questions:
-            await send_question(update.effective_chat.id, context)
+        # Jump to a specific question number in Learning
+        n = number
+        total = N_QUESTIONS
+        if 1 <= n <= total:
+            # When jumping, remove the previous question message if it still has an inline keyboard
+            last_id = chat_data.get("last_message_id")
+            last_has_kb = chat_data.get("last_has_kb")
+            if last_id and last_has_kb:
+                try:
+                    await context.bot.delete_message(chat_id=chat_id, message_id=last_id)
+                except Exception:
+                    # If deletion fails (already gone/edited), ignore
+                    pass
+                chat_data["last_message_id"] = None
+                chat_data["last_has_kb"] = False
+            chat_data["current_index"] = n - 1
+            await send_question(chat_id, context)
         else:
-            await send_score(update.effective_chat.id, context)
+            await update.message.reply_text(f"⚠️ Please enter a number from 1 to {total}.")
         return
+    current_index = chat_data.get("current_index", 0)
+    if mode == "exam":
+        question_index = chat_data["exam_questions"][current_index]
+    else:
+        question_index = current_index
+    # Accept answers as full text (EN/UK), letter (A–D) or number (1–4), allowing for typos
+    selected_index = match_text_answer(question_index, user_msg.lower())
+    # If not recognized, reply and do NOT advance
+    if selected_index < 0 or selected_index >= 4:
+        await update.message.reply_text("❌ Could not recognize your answer. Please reply with the full text or letter (A, B, C, D).")
+        return
+    correct_index = Q_ANSWER_IDX[question_index]
+    is_correct = selected_index == correct_index
+    if is_correct:
+        chat_data["score"] = chat_data.get("score", 0) + 1
+    elif mode == "learning":
+        chat_data["wrong_count"] = chat_data.get("wrong_count", 0) + 1
+    # Prepare feedback message: один рядок-шаблон замість збирання списку
+    feedback = "✅ Correct!" if is_correct else "❌ Incorrect."
+    # In learning mode, show explanation
+    expl = Q_EXPL[question_index]
+    if mode == "learning" and expl is not None:
+        bar = progress_bar(current_index + 1, N_QUESTIONS, chat_data.get("wrong_steps", set()))
+        feedback = f"{feedback}\n{bar}\n<b>Explanation:</b>\n<i>{expl}</i>"
+    # Reply to user
+    await update.message.reply_text(feedback)
+    # Advance to next question
+    await _advance(chat_id, context)
+    return
 
 @antispam
+@safe_answer
 async def next_handler(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    import telegram.error
-    try:
-        await query.answer()
-    except telegram.error.BadRequest as e:
-        if "Query is too old" in str(e):
-            logger.warning("Callback query too old; skipping answer.")
-        else:
-            raise
     chat_data = context.chat_data
     if not chat_data or not chat_data.get("awaiting_next"):
         if query.message:
             await query.edit_message_text(
                 "❗️Quiz not active. Please start again.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔁 Start Again", callback_data="mode_exam")]])
+                reply_markup=RESTART_KB
             )
         return
     if query.data == "RESTART":
-        chat_data.clear()
+        # Скидаємо лише стан проходу (як після підсумку), без clear() — дикт і lang_mode лишаються
+        for key in QUIZ_STATE_KEYS:
+            chat_data.pop(key, None)
+        chat_data.pop("_last_start_at", None)  # щоб debounce у start не проковтнув рестарт
         await query.edit_message_reply_markup(reply_markup=None)
         await context.bot.send_message(chat_id=update.effective_chat.id, text="🔁 Restarting test...")
         await start(update, context)
@@ -1073,41 +1243,100 @@ async def next_handler(update: Update, context: CallbackContext) -> None:
         await send_question(update.effective_chat.id, context)
         return
     # For all other cases, immediately move to next question (no NEXT button logic)
-    current_index = chat_data.get("current_index", 0) + 1
-    chat_data["current_index"] = current_index
-    chat_data.pop("awaiting_next", None)
-    max_questions = len(chat_data.get("exam_questions", [])) if chat_data.get("mode", "learning") == "exam" else len(QUESTIONS)
-    if current_index < max_questions:
-        await send_question(update.effective_chat.id, context)
-    else:
-        await send_score(update.effective_chat.id, context)
+    await _advance(update.effective_chat.id, context)
 
 
+# --- Pause/resume handlers ---
+@antispam
+@safe_answer
+async def handle_pause(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await _purge_ui_soft(context, query.message.chat.id)
+    context.chat_data["paused"] = True
+    context.chat_data["resume_question"] = context.chat_data.get("current_index", 0)
+    await query.edit_message_text("⏸ Test paused. You can continue anytime by selecting Continue from the main menu.")
+
+@antispam
+@safe_answer
+async def handle_resume_pause(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    await _purge_ui_soft(context, query.message.chat.id)
+    context.chat_data["paused"] = False
+    context.chat_data["current_index"] = context.chat_data.get("resume_question", 0)
+    await send_question(query.message.chat.id, context)
+
+
+# --- Callback routing: один обробник, точний пошук callback_data у словнику ---
+CALLBACK_ROUTES = {
+    "NEXT": next_handler,
+    "CONTINUE": next_handler,
+    "RESTART": next_handler,
+    **{letter: answer_handler for letter in OPTION_LETTERS},
+    "lang_en": handle_language,
+    "lang_bilingual": handle_language,
+    "mode_learning": handle_mode,
+    "mode_exam": handle_mode,
+    "mode_pause": handle_pause,
+    "RESUME_PAUSE": handle_resume_pause,
+    "MAIN_MENU": handle_main_menu,
+}
+
+async def route_callback(update: Update, context: CallbackContext) -> None:
+    return await CALLBACK_ROUTES[update.callback_query.data](update, context)
+
+RESTART_TEXT_RE = re.compile(r"(?i)^\s*🔄?\s*restart\s*bot\s*$")
+
+class FastJSONRequest(HTTPXRequest):
+    """HTTPXRequest, що розбирає відповіді Bot API через orjson (якщо встановлений)."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        if orjson:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass  # нехай stdlib-версія залогує й кине TelegramError
+        return HTTPXRequest.parse_json_payload(payload)
+
 def main() -> None:
     token = os.getenv("BOT_TOKEN")
     if not token:
         raise RuntimeError("The BOT_TOKEN environment variable is not set.")
 
-    application = ApplicationBuilder().token(token).defaults(
-        Defaults(parse_mode=ParseMode.MARKDOWN)
-    ).post_init(post_init).build()
+    # Цикл подій на libuv — run_webhook підхопить його через політику
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Спільний HTTP/2-клієнт із пулом: вихідні виклики Bot API перевикористовують з'єднання
+    request = FastJSONRequest(
+        connection_pool_size=CONCURRENT_UPDATES,
+        http_version="2",
+        connect_timeout=5,
+        read_timeout=20,
+        write_timeout=20,
+        pool_timeout=5,
+    )
+
+    # До CONCURRENT_UPDATES апдейтів обробляються паралельно; в межах чату дублі тисків
+    # відсікає antispam-лок у chat_data
+    application = ApplicationBuilder().token(token).request(request).concurrent_updates(CONCURRENT_UPDATES).defaults(
+        Defaults(parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    ).post_init(post_init).post_shutdown(post_shutdown).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("stop", stop_command))
-    application.add_handler(CallbackQueryHandler(next_handler, pattern="^(NEXT|CONTINUE|RESTART)$"))
-    application.add_handler(CallbackQueryHandler(answer_handler, pattern="^[ABCDSTOP]{1,4}$"))
-    application.add_handler(CallbackQueryHandler(handle_language, pattern="^lang_.*$"))
-    application.add_handler(CallbackQueryHandler(handle_mode, pattern="^mode_.*$"))
-    application.add_handler(CallbackQueryHandler(handle_pause, pattern="^mode_pause$"))
-    application.add_handler(CallbackQueryHandler(handle_resume_pause, pattern="^RESUME_PAUSE$"))
-    application.add_handler(CallbackQueryHandler(handle_main_menu, pattern="^MAIN_MENU$"))
+    # Невідомі callback_data (старі кнопки) не матчаться — як і раніше
+    application.add_handler(CallbackQueryHandler(route_callback, pattern=CALLBACK_ROUTES.__contains__))
     application.add_handler(
         MessageHandler(
-            filters.Regex(r"(?i)^\s*🔄?\s*restart\s*bot\s*$"),
+            filters.Regex(RESTART_TEXT_RE),
             start,
         )
     )
-    application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), answer_handler))
+    # Лише нові повідомлення: редагування старого тексту не є відповіддю (і update.message там None)
+    application.add_handler(
+        MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & (~filters.COMMAND), text_answer_handler)
+    )
 
     port = int(os.environ.get("PORT", 10000))
     render_url = os.environ.get("RENDER_EXTERNAL_URL")
@@ -1115,7 +1344,6 @@ def main() -> None:
         raise RuntimeError("RENDER_EXTERNAL_URL is not set. Make sure your environment provides it.")
 
     # Add global error handler
-    from telegram.error import TelegramError
     async def error_handler(update, context):
         logger.error(msg="Exception while handling an update:", exc_info=context.error)
     application.add_error_handler(error_handler)
@@ -1127,40 +1355,5 @@ def main() -> None:
     )
 
 
-# --- Pause/resume handlers ---
-import telegram.error
-@antispam
-async def handle_pause(update: Update, context: CallbackContext) -> None:
-    query = update.callback_query
-    try:
-        await query.answer()
-        await _purge_ui_soft(context, query.message.chat.id)
-    except telegram.error.BadRequest as e:
-        if "Query is too old" in str(e):
-            logger.warning("Callback query too old; skipping answer.")
-            return
-        else:
-            raise
-    context.chat_data["paused"] = True
-    context.chat_data["resume_question"] = context.chat_data.get("current_index", 0)
-    await query.edit_message_text("⏸ Test paused. You can continue anytime by selecting Continue from the main menu.")
-
-@antispam
-async def handle_resume_pause(update: Update, context: CallbackContext) -> None:
-    query = update.callback_query
-    try:
-        await query.answer()
-        await _purge_ui_soft(context, query.message.chat.id)
-    except telegram.error.BadRequest as e:
-        if "Query is too old" in str(e):
-            logger.warning("Callback query too old; skipping answer.")
-            return
-        else:
-            raise
-    context.chat_data["paused"] = False
-    context.chat_data["current_index"] = context.chat_data.get("resume_question", 0)
-    await send_question(query.message.chat.id, context)
-
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""Підсумок → «Restart Learning»: натиснутий підсумок редагується, а не видаляється."""
+import asyncio
+import itertools
+import os
+import sys
+from types import SimpleNamespace
+
+import telegram.error
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # main читає questions.json та images/ відносно кореня
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+CHAT_ID = 1
+
+
+class FakeBot:
+    def __init__(self):
+        self._ids = itertools.count(100)
+        self.deleted = set()
+        self.sent = []
+
+    def _message(self, **kwargs):
+        msg = SimpleNamespace(message_id=next(self._ids), photo=None, **kwargs)
+        self.sent.append(msg)
+        return msg
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        return self._message(text=text)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return self._message(text=None)
+
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.add(message_id)
+
+
+class FakeQuery:
+    def __init__(self, bot, message, data):
+        self.bot = bot
+        self.message = message
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    def _check_alive(self):
+        if self.message.message_id in self.bot.deleted:
+            raise telegram.error.BadRequest("Message to edit not found")
+
+    async def edit_message_reply_markup(self, reply_markup=None):
+        self._check_alive()
+
+    async def edit_message_text(self, text, **kwargs):
+        self._check_alive()
+        return self.message
+
+
+def test_restart_from_summary_edits_clicked_message_and_sends_question():
+    bot = FakeBot()
+    context = SimpleNamespace(
+        bot=bot,
+        job_queue=None,
+        chat_data={"lang_mode": "en", "mode": "learning", "score": 3, "wrong_count": 1, "current_index": 4},
+    )
+
+    async def run():
+        await main.send_score(CHAT_ID, context)
+        summary = bot.sent[-1]
+        assert context.chat_data["summary_message_id"] == summary.message_id
+
+        message = SimpleNamespace(
+            message_id=summary.message_id,
+            chat=SimpleNamespace(id=CHAT_ID),
+            text_html=summary.text,
+            reply_markup=main.LEARNING_SCORE_KB,
+            photo=None,
+        )
+        update = SimpleNamespace(
+            callback_query=FakeQuery(bot, message, "mode_learning"),
+            effective_chat=SimpleNamespace(id=CHAT_ID),
+            message=None,
+        )
+        await main.handle_mode(update, context)
+        return summary
+
+    summary = asyncio.run(run())
+    assert summary.message_id not in bot.deleted
+    # після підсумку надіслано перше питання
+    assert bot.sent[-1] is not summary
+    assert context.chat_data["last_message_id"] == bot.sent[-1].message_id
+    assert context.chat_data["current_index"] == 0